@@ -1,29 +1,173 @@
 import logging
 import numpy as np
+import os
 import re
 import socket
+import sys
+import time
 
-from base64 import b64encode
 from typing import List
 
+try:
+    # SIMD accelerated encoder, a lot faster than the standard library one
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
 log = logging.getLogger(__name__)
 TIMEOUT = 3
+# Longest line accepted by the server, including the new line character
+MAX_LINE_LENGTH = 1024
+# Requested socket buffer sizes, only used when they fit in net.core.wmem_max
+# and net.core.rmem_max
+SOCKET_BUFFER_SIZE = 4 << 20
+# Limits of the send and receive buffer sizes
+BUFFER_SIZE_LIMITS = {
+    socket.SO_SNDBUF: '/proc/sys/net/core/wmem_max',
+    socket.SO_RCVBUF: '/proc/sys/net/core/rmem_max',
+}
+# Values that could be parsed as a float, nan and inf included
+FLOATISH = re.compile(rb'^(?:[-+0-9.e]+|[-+]?(?:nan|inf(?:inity)?))$',
+                      re.IGNORECASE)
+# Not exported by the socket module, value from Linux's asm/socket.h
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+def set_quickack(sock: socket.socket):
+    # disable delayed ACKs (Linux only), the kernel can re-enable them at any
+    # point, so this needs to be called again after receiving data
+    if hasattr(socket, 'TCP_QUICKACK'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+
+def set_buffer_sizes(sock: socket.socket):
+    # bigger buffers absorb bursts when pushing tables or capturing data,
+    # they have to be set before connecting for the TCP window to use them.
+    # Setting a size turns off the kernel autotuning of that buffer and the
+    # size is capped to the limit, so only set it when it fits in the limit
+    # and grows the current buffer
+    for option, limit_path in BUFFER_SIZE_LIMITS.items():
+        try:
+            with open(limit_path) as f:
+                limit = int(f.read())
+        except (OSError, ValueError):
+            continue
+
+        current = sock.getsockopt(socket.SOL_SOCKET, option)
+        if current < SOCKET_BUFFER_SIZE <= limit:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+
+
+def set_busy_poll(sock: socket.socket, usecs: int):
+    # busy poll the device queue for up to usecs when waiting for data,
+    # this saves the wake up latency on every round trip but burns CPU while
+    # waiting, so it is opt-in. Raising it above net.core.busy_read needs
+    # CAP_NET_ADMIN, so failures aren't fatal
+    if not usecs or not sys.platform.startswith('linux'):
+        return
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, usecs)
+    except OSError as e:
+        log.warning('Could not set SO_BUSY_POLL: %s', e)
+
+
+def sendmsg_all(sock: socket.socket, buffers: List[bytes]):
+    # gather the buffers in sendmsg calls, sendmsg can send only part of the
+    # data, in which case we continue from where it stopped. Empty buffers
+    # are left out, as sending only those would return 0 and never finish
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        while sent:
+            if sent >= len(views[i]):
+                sent -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][sent:]
+                sent = 0
+
+
+def wait_until(condition, min_period: float = 0.001, max_period: float = 0.05,
+               spins: int = 0):
+    # the first polls are done back to back, reacting as soon as possible at
+    # the cost of keeping the CPU and the server busy, then poll with an
+    # exponential backoff, so that long waits don't flood the server
+    for _ in range(spins):
+        if condition():
+            return
+
+    period = min_period
+    while not condition():
+        time.sleep(period)
+        period = min(2 * period, max_period)
+
+
+def wait_queue_below(get_queued, limit: int, line_period: float,
+                     min_period: float = 0.001, max_period: float = 0.05,
+                     spins: int = 0):
+    # the queue is consumed at one line per period, so rather than polling
+    # its level, sleep for the time the lines over the limit take to be
+    # consumed and only then poll for whatever is left
+    queued = get_queued()
+    if queued < limit:
+        return
+
+    time.sleep((queued - limit + 1) * line_period)
+    wait_until(lambda: get_queued() < limit, min_period, max_period, spins)
+
+
+def parse_value(path: str, result: bytes):
+    # parse the response to a get of path
+    if result.startswith(b'ERR'):
+        raise ValueError(f'Error putting {path}: {result}')
+    elif result.startswith(b'!'):
+        return [int(i[1:]) for i in result.split()[:-1]]
+    else:
+        if b'=' not in result:
+            raise ValueError(
+                f'Unexpected response for {path}: {result}')
+        val = result.split(b'=', 1)[1].strip()
+        if val.isdigit():
+            return int(val)
+        if FLOATISH.match(val):
+            try:
+                return float(val)
+            except ValueError:
+                pass
+
+        return val.decode()
 
 
 class PandaClient(object):
-    def __init__(self, host: str):
+    def __init__(self, host: str, max_line_length: int = MAX_LINE_LENGTH,
+                 busy_poll_us: int = 0):
         self.host = host
+        self.busy_poll_us = busy_poll_us
+        # Biggest number of bytes per line, multiple of the word size and of
+        # 3 (so that lines can be cut from a single base64 encoded buffer),
+        # that doesn't exceed the maximum line length once encoded
+        self.table_chunk_size = 12 * ((max_line_length - 1) // 16)
         self.fields = []
         self.capture_fields = []
         self.instances = set()
         self.sock = None
+        self._items = {}
 
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(TIMEOUT)
         # disable Nagle's algorithm to reduce latency
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        set_buffer_sizes(self.sock)
+        set_busy_poll(self.sock, self.busy_poll_us)
         self.sock.connect((self.host, 8888))
+        set_quickack(self.sock)
         self.fetch_metadata()
 
     def get_first_instance_name(self, block_name: str):
@@ -33,18 +177,14 @@ class PandaClient(object):
         return ''
 
     def get_field_names_with(self, string: str):
-        result = []
-        for i in self.fields:
-            if re.search(string, i):
-                result.append(i)
-        return result
+        pattern = re.compile(string)
+        return [i for i in self.fields if pattern.search(i)]
 
     def close(self):
         self.sock.close()
 
     def disable_captures(self):
-        for field in self.capture_fields:
-            self.send_recv(f'{field}=No')
+        self.send_recv_many([f'{field}=No' for field in self.capture_fields])
 
     def fetch_metadata(self):
         result = bytearray()
@@ -71,42 +211,111 @@ class PandaClient(object):
         if isinstance(command, str):
             command = [command]
 
-        for line in command:
-            self.sock.sendall(line.encode())
-            self.sock.sendall(b'\n')
+        buffers = [f'{line}\n'.encode() for line in command]
+        if hasattr(self.sock, 'sendmsg'):
+            # avoid joining all the lines into a big intermediate buffer
+            sendmsg_all(self.sock, buffers)
+        else:
+            self.sock.sendall(b''.join(buffers))
+
+    def send_bytes(self, buffers: List[bytes]):
+        if hasattr(self.sock, 'sendmsg'):
+            sendmsg_all(self.sock, buffers)
+        else:
+            self.sock.sendall(b''.join(buffers))
 
     def recv(self):
-        result = bytearray()
-        while not result.endswith(b'\n'):
-            result.extend(self.sock.recv(4096))
+        # only the last received chunk needs to be checked for the new line
+        chunks = []
+        while True:
+            chunk = self.sock.recv(1<<16)
+            set_quickack(self.sock)
+            if not chunk:
+                raise ConnectionError(f'Connection to {self.host} closed')
 
-        return result
+            chunks.append(chunk)
+            if chunk.endswith(b'\n'):
+                return b''.join(chunks)
 
     def send_recv(self, commands: str | List[str]):
         self.send(commands)
         return self.recv()
 
-    def prepare_table_command(self, name: str, content: np.ndarray,
-                              streaming=False, last=False):
+    def send_recv_many(self, commands: List[str]) -> List[bytes]:
+        # pipeline commands, all of them are sent before reading the
+        # responses, so we only wait for one round trip. Multi-line responses
+        # (starting with ! and ending with .) are returned as a single item
+        if not commands:
+            return []
 
+        self.send(commands)
+        responses = []
+        multiline = []
+        while len(responses) < len(commands):
+            for line in self.recv().splitlines():
+                if multiline or line.startswith(b'!'):
+                    multiline.append(line)
+                    if line == b'.':
+                        responses.append(b'\n'.join(multiline))
+                        multiline = []
+                else:
+                    responses.append(line)
+
+        return responses
+
+    def put_many(self, values: dict):
+        # put several fields pipelined, in order
+        fields = list(values)
+        results = self.send_recv_many(
+            [f'{field}={val}' for field, val in values.items()])
+        for field, result in zip(fields, results):
+            if not result.startswith(b'OK'):
+                raise ValueError(f'Error putting {field}: {result}')
+
+    def table_header(self, name: str, streaming=False, last=False):
         suffix = '<'
         if streaming and last:
             suffix = '<<|'
         elif streaming:
             suffix = '<<'
 
-        commands = [f'{name}{suffix}B']
-        chunk_size = 191
-        #chunk_size = 767
-        for i in range(0, len(content), chunk_size):
-            commands.append(b64encode(content[i:i+chunk_size]).decode())
-        commands.append('')
-        return commands
+        return f'{name}{suffix}B\n'.encode()
+
+    def encode_table(self, content: np.ndarray):
+        # encode the little endian words at once and cut the lines from the
+        # result, the chunk size is a multiple of 3 so there is no padding
+        buf = memoryview(np.ascontiguousarray(content, dtype='<u4')
+                         ).cast('B')
+        encoded = memoryview(b64encode(buf))
+        line_length = self.table_chunk_size // 3 * 4
+        lines = []
+        for i in range(0, len(encoded), line_length):
+            lines.append(encoded[i:i+line_length])
+        # the empty line ends the table
+        lines.append(b'')
+        return b'\n'.join(lines) + b'\n'
+
+    def prepare_table_command(self, name: str, content: np.ndarray,
+                              streaming=False, last=False):
+        # the header and the encoded table are kept apart, so that they are
+        # gathered in the send instead of copying the table to join them
+        return (self.table_header(name, streaming, last),
+                self.encode_table(content))
 
     def put_table(self, name: str, content: np.ndarray,
                   streaming=False, last=False):
-        return self.send_recv(self.prepare_table_command(name, content,
-                                                         streaming, last))
+        header, body = self.prepare_table_command(name, content, streaming,
+                                                  last)
+        self.send_bytes([header, body])
+        return self.recv()
+
+    def put_encoded_table(self, name: str, encoded: bytes,
+                          streaming=False, last=False):
+        # put a table encoded with encode_table, the header and the encoded
+        # table are gathered in the send, without joining them
+        self.send_bytes([self.table_header(name, streaming, last), encoded])
+        return self.recv()
+
     def arm(self):
         self.send_recv('*PCAP.ARM=')
 
@@ -117,31 +326,50 @@ class PandaClient(object):
         data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # disable Nagle's algorithm to reduce latency
         data_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        set_buffer_sizes(data_sock)
+        set_busy_poll(data_sock, self.busy_poll_us)
         data_sock.connect((self.host, 8889))
+        set_quickack(data_sock)
         data_sock.sendall(b'UNFRAMED RAW NO_HEADER NO_STATUS ONE_SHOT\n')
-        acc = bytearray()
+        # keep the received chunks in a list and join them only when a
+        # result is yielded, to avoid growing and copying a single buffer
+        chunks = []
+        total = 0
         while True:
             chunk = data_sock.recv(1<<17)
             if not chunk:
                 break
 
-            acc.extend(chunk)
+            set_quickack(data_sock)
+            chunks.append(chunk)
+            total += len(chunk)
             if nbytes:
-                if len(acc) >= nbytes:
-                    yield acc[:nbytes]
-                    acc = acc[nbytes:]
-            elif len(acc) % 4 == 0:
-                yield acc
-                acc = bytearray()
-
-        if acc:
-            yield acc
+                if total >= nbytes:
+                    acc = b''.join(chunks)
+                    start = 0
+                    while total - start >= nbytes:
+                        yield acc[start:start + nbytes]
+                        start += nbytes
+
+                    chunks = [acc[start:]] if start < total else []
+                    total -= start
+            elif total % 4 == 0:
+                yield b''.join(chunks)
+                chunks = []
+                total = 0
+
+        if chunks:
+            yield b''.join(chunks)
 
         data_sock.close()
 
     def __getattr__(self, name):
         if name.isupper():
-            return Item(name, self)
+            item = self._items.get(name)
+            if item is None:
+                item = self._items[name] = Item(name, self)
+
+            return item
 
     def __getitem__(self, item):
         item = item.upper()
@@ -153,12 +381,21 @@ class PandaClient(object):
 
 
 class Item(object):
+    __slots__ = ('path', 'client', '_children')
+
     def __init__(self, path: str, client: PandaClient):
         self.path = path
         self.client = client
+        self._children = {}
 
     def __getattr__(self, name):
-        return Item(f'{self.path}.{name}', self.client)
+        # children are cached, so polling loops don't create new items
+        child = self._children.get(name)
+        if child is None:
+            child = self._children[name] = Item(f'{self.path}.{name}',
+                                                self.client)
+
+        return child
 
     def __getitem__(self, item):
         item = item.upper()
@@ -178,23 +415,7 @@ class Item(object):
                 chunk = self.client.recv()
                 result.extend(chunk)
 
-        if result.startswith(b'ERR'):
-            raise ValueError(f'Error putting {self.path}: {result}')
-        elif result.startswith(b'!'):
-            return [int(i[1:]) for i in result.split()[:-1]]
-        else:
-            if b'=' not in result:
-                raise ValueError(
-                    f'Unexpected response for {self.path}: {result}')
-            val = result.split(b'=', 1)[1].strip()
-            if val.isdigit():
-                return int(val)
-            try:
-                return float(val)
-            except ValueError:
-                return val.decode()
-
-        return result
+        return parse_value(self.path, result)
 
     def put(self, val: str | np.ndarray):
         if isinstance(val, np.ndarray):
@@ -4,9 +4,16 @@ import logging
 import math
 import multiprocessing
 import numpy as np
+import queue
+import threading
 import time
 
-from panda import PandaClient
+from panda import PandaClient, wait_queue_below
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +30,13 @@ def parse_args():
         return val
     parser.add_argument('--nblocks', type=nblocks_type, default=1)
     parser.add_argument('--fpga-freq', type=int, default=125000000)
+    parser.add_argument('--poll-min-period', type=float, default=0.001)
+    parser.add_argument('--poll-max-period', type=float, default=0.05)
+    parser.add_argument('--poll-spins', type=int, default=100)
+    # SO_BUSY_POLL time, trading CPU for lower latency on each round trip
+    parser.add_argument('--busy-poll-us', type=int, default=0)
+    # report every block, printing them can't keep up with fast clocks
+    parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('host')
     args = parser.parse_args()
     if args.repeats != 1 and args.nblocks != 1:
@@ -33,40 +47,58 @@ def parse_args():
 
 def configure_layout(client):
     pgen_name = client.get_first_instance_name('PGEN')
-    pgen = client[pgen_name]
     clock_name = client.get_first_instance_name('CLOCK')
-    clock = client[clock_name]
-    pgen.ENABLE.put('ZERO')
-    pgen.OUT.UNITS.put('')
-    pgen.OUT.OFFSET.put(0)
-    pgen.OUT.SCALE.put(1)
-    pgen.ENABLE.DELAY.put(0)
-    pgen.TRIG.DELAY.put(0)
-    pgen.REPEATS.put(1)
-    pgen.TRIG.put(f'{clock_name}.OUT')
+    # the fields are put pipelined, instead of one round trip each
+    client.put_many({
+        f'{pgen_name}.ENABLE': 'ZERO',
+        f'{pgen_name}.OUT.UNITS': '',
+        f'{pgen_name}.OUT.OFFSET': 0,
+        f'{pgen_name}.OUT.SCALE': 1,
+        f'{pgen_name}.ENABLE.DELAY': 0,
+        f'{pgen_name}.TRIG.DELAY': 0,
+        f'{pgen_name}.REPEATS': 1,
+        f'{pgen_name}.TRIG': f'{clock_name}.OUT',
+    })
     client.put_table(f'{pgen_name}.TABLE', np.arange(0))
-    clock.ENABLE.put(f'{pgen_name}.ACTIVE')
-    clock.ENABLE.DELAY.put(0)
-    clock.PERIOD.UNITS.put('s')
-    clock.WIDTH.UNITS.put('s')
-    clock.PERIOD.put(1)
-    clock.WIDTH.put(0)
-    client.PCAP.ENABLE.put(f'{pgen_name}.ACTIVE')
-    client.PCAP.ENABLE.DELAY.put(10)
-    client.PCAP.TRIG.put(f'{clock_name}.OUT')
-    client.PCAP.TRIG.DELAY.put(1)
-    client.PCAP.TRIG_EDGE.put('Rising')
-    client.PCAP.GATE.put('ONE')
-    client.PCAP.GATE.DELAY.put(0)
-    client.PCAP.SHIFT_SUM.put(0)
-    client.PCAP.TS_TRIG.CAPTURE.put('No')
-    pgen.OUT.CAPTURE.put('Value')
+    client.put_many({
+        f'{clock_name}.ENABLE': f'{pgen_name}.ACTIVE',
+        f'{clock_name}.ENABLE.DELAY': 0,
+        f'{clock_name}.PERIOD.UNITS': 's',
+        f'{clock_name}.WIDTH.UNITS': 's',
+        f'{clock_name}.PERIOD': 1,
+        f'{clock_name}.WIDTH': 0,
+        'PCAP.ENABLE': f'{pgen_name}.ACTIVE',
+        'PCAP.ENABLE.DELAY': 10,
+        'PCAP.TRIG': f'{clock_name}.OUT',
+        'PCAP.TRIG.DELAY': 1,
+        'PCAP.TRIG_EDGE': 'Rising',
+        'PCAP.GATE': 'ONE',
+        'PCAP.GATE.DELAY': 0,
+        'PCAP.SHIFT_SUM': 0,
+        'PCAP.TS_TRIG.CAPTURE': 'No',
+        f'{pgen_name}.OUT.CAPTURE': 'Value',
+    })
+
+
+def encode_tables(args, client, tables_q):
+    block_start = args.start_number
+    offsets = np.arange(args.lines_per_block, dtype=np.uint32)
+    content = np.empty(args.lines_per_block, dtype=np.uint32)
+    try:
+        for i in range(args.nblocks):
+            # uint32 addition wraps around as the values captured from PGEN do
+            np.add(offsets, np.uint32(block_start & 0xffffffff), out=content)
+            tables_q.put((block_start, client.encode_table(content)))
+            block_start += args.lines_per_block
+    except Exception as e:
+        # handle_pgen would wait for the next table forever, the error is
+        # passed on to be raised there instead
+        tables_q.put(e)
 
 
 def handle_pgen(args):
-    client = PandaClient(args.host)
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
     client.connect()
-    configure_layout(client)
     pgen_name = client.get_first_instance_name('PGEN')
     pgen = client[pgen_name]
     clock_name = client.get_first_instance_name('CLOCK')
@@ -74,59 +106,87 @@ def handle_pgen(args):
     pgen.REPEATS.put(args.repeats)
     ticks = math.floor(args.clock_period_us * 1e-6 * args.fpga_freq)
     client[clock_name].PERIOD.RAW.put(ticks)
+    # a value is output on each clock pulse
+    line_period = ticks / args.fpga_freq
     print(f'Lines per block {args.lines_per_block}')
     print(f'Number of blocks {args.nblocks}')
     print(f'Clock period {args.clock_period_us} us')
     print(f'Bandwidth {bw:.3f} MiB/s')
     print(f'Total size {args.lines_per_block * args.nblocks * 4 / 1024**2:.3f} MiB')
-    block_start = args.start_number
-    block_stop = args.start_number + args.lines_per_block
     streaming = args.nblocks > 1
+    # encode the next table while the previous one is sent and consumed
+    tables_q = queue.Queue(2)
+    encoder = threading.Thread(target=encode_tables,
+                               args=(args, client, tables_q),
+                               daemon=True)
+    encoder.start()
     for i in range(args.nblocks):
         t1 = time.time()
-        mblock_start = block_start & 0xffffffff
-        mblock_stop = block_stop & 0xffffffff
-        if mblock_start > mblock_stop:
-            content1 = np.arange(mblock_start, 2**32, dtype=np.uint32)
-            content2 = np.arange(0, mblock_stop, dtype=np.uint32)
-            content = np.concatenate((content1, content2))
-        else:
-            content = np.arange(mblock_start, mblock_stop, dtype=np.uint32)
-        print(f'Pushing table {i} from {block_start} to {block_stop - 1}')
-        block_start += args.lines_per_block
-        block_stop += args.lines_per_block
-        result = client.put_table(
-            f'{pgen_name}.TABLE', content, streaming=(args.nblocks > 1),
+        item = tables_q.get()
+        if isinstance(item, Exception):
+            raise item
+
+        block_start, encoded = item
+        log.debug('Pushing table %d from %d to %d', i, block_start,
+                  block_start + args.lines_per_block - 1)
+        result = client.put_encoded_table(
+            f'{pgen_name}.TABLE', encoded, streaming=streaming,
             last=(i == args.nblocks - 1))
         t2 = time.time()
-        print(f'time to push table {i}: {t2 - t1}')
+        log.debug('time to push table %d: %f', i, t2 - t1)
         assert result.startswith(b'OK'), f'Error putting table: {result}'
-        while streaming and pgen.TABLE.QUEUED_LINES.get() > 2 * args.lines_per_block:
-            time.sleep(0.1)
-
+        # nothing else to push after the last table
+        if streaming and i < args.nblocks - 1:
+            wait_queue_below(pgen.TABLE.QUEUED_LINES.get,
+                             2 * args.lines_per_block + 1, line_period,
+                             args.poll_min_period, args.poll_max_period,
+                             args.poll_spins)
+
+    encoder.join()
     client.close()
 
 
+# Types of the captured words, read-only as they come from the received
+# bytes, the first expected entry and the period passed to find_mismatch
+MISMATCH_SIGNATURE = '(Array(uint32, 1, "C", readonly=True), int64, int64)'
+
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def find_mismatch(adata, start, period):
+        expected = start % period
+        for j in range(adata.shape[0]):
+            if adata[j] != expected:
+                return j
+
+            expected += 1
+            if expected == period:
+                expected = 0
+
+        return -1
+else:
+    def find_mismatch(adata, start, period):
+        entries = np.arange(start, start + len(adata), dtype=np.uint64)
+        expected = (entries % period).astype(np.uint32)
+        if np.array_equal(adata, expected):
+            return -1
+
+        return np.flatnonzero(adata != expected)[0]
+
+
 def handle_pcap(args):
-    client = PandaClient(args.host)
-    client.connect()
-    client.disable_captures()
-    pgen_name = client.get_first_instance_name('PGEN')
-    pgen = client[pgen_name]
-    pgen.OUT.CAPTURE.put('Value')
-    client.arm()
+    # the capture is armed by main, only the data connection is needed
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
     i = args.start_number
     last_time = 0
     PRINT_PERIOD = 3
+    period = args.lines_per_block if args.repeats > 1 else 2**32
     for data in client.collect():
         adata = np.frombuffer(data, dtype=np.uint32)
-        for j in range(len(adata)):
-            if args.repeats > 1:
-                expected = (i + j) % args.lines_per_block
-            else:
-                expected = (i + j) & 0xffffffff
-            assert adata[j] == expected, \
-                f'Entry {i + j} = {adata[j]}, expected {expected}'
+        j = find_mismatch(adata, i, period)
+        if j >= 0:
+            raise AssertionError(
+                f'Entry {i + j} = {adata[j]}, expected {(i + j) % period}')
 
         i += len(adata)
         current_time = time.time()
@@ -138,11 +198,30 @@ def handle_pcap(args):
     expected = args.lines_per_block * args.nblocks * args.repeats
     assert i == expected, \
         f'Expected {expected} lines, got {i}'
-    client.close()
 
 
 def main():
     args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    if njit is not None:
+        # compiling the checking kernel on the first captured chunk takes
+        # longer than the socket can buffer, so it is compiled, or loaded
+        # from the cache, before arming and the pcap worker inherits it
+        find_mismatch.compile(MISMATCH_SIGNATURE)
+
+    # configure and arm on a single connection before starting the workers,
+    # the one collecting the data doesn't need a control connection
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
+    client.connect()
+    configure_layout(client)
+    pgen_name = client.get_first_instance_name('PGEN')
+    pgen = client[pgen_name]
+    client.disable_captures()
+    pgen.OUT.CAPTURE.put('Value')
+    client.arm()
     procs = []
     procs.append(
         multiprocessing.Process(target=handle_pgen, args=(args,)))
@@ -151,10 +230,6 @@ def main():
     for proc in procs:
         proc.start()
     time.sleep(1)
-    client = PandaClient(args.host)
-    client.connect()
-    pgen_name = client.get_first_instance_name('PGEN')
-    pgen = client[pgen_name]
     pgen.ENABLE.put('ZERO')
     print('Enabling PGEN')
     pgen.ENABLE.put('ONE')
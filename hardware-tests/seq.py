@@ -4,10 +4,18 @@ import logging
 import math
 import multiprocessing
 import numpy as np
-import random
+import os
+import queue
+import threading
 import time
 
-from panda import PandaClient
+from multiprocessing import shared_memory
+from panda import PandaClient, wait_queue_below
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +29,22 @@ def parse_args():
     parser.add_argument('--fpga-freq', type=int, default=125000000)
     parser.add_argument('--max-blocks-queued', type=int, default=7)
     parser.add_argument('--checker-threads', type=int, default=1)
+    parser.add_argument('--poll-min-period', type=float, default=0.001)
+    parser.add_argument('--poll-max-period', type=float, default=0.05)
+    parser.add_argument('--poll-spins', type=int, default=100)
+    # SO_BUSY_POLL time, trading CPU for lower latency on each round trip
+    parser.add_argument('--busy-poll-us', type=int, default=0)
+    # Number of captured blocks that can be waiting to be checked
+    parser.add_argument('--pcap-slots', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=None)
+    # report every block, printing them can't keep up with fast clocks
+    parser.add_argument('-v', '--verbose', action='store_true')
+    # threads share the tables and captured data without any IPC, they only
+    # scale when the checking releases the GIL, which needs numba
+    parser.add_argument('--workers', choices=('auto', 'threads', 'processes'),
+                        default='auto')
+    # pin each worker to its own core
+    parser.add_argument('--pin-cpus', action='store_true')
     parser.add_argument('host')
     args = parser.parse_args()
 
@@ -30,42 +54,54 @@ def parse_args():
     if args.repeats != 1 and args.nblocks != 1:
         raise ValueError('repeats and nblocks cannot be used together')
 
+    if args.pcap_slots < args.checker_threads:
+        raise ValueError('pcap-slots must be at least checker-threads')
+
+    if args.workers == 'auto':
+        args.workers = 'threads' if njit is not None else 'processes'
+    elif args.workers == 'threads' and njit is None:
+        log.warning('numba is not available, checker threads will contend '
+                    'for the GIL')
+
     return args
 
 
 def configure_layout(client):
     seq_name = client.get_first_instance_name('SEQ')
-    seq = client[seq_name]
     clock_name = client.get_first_instance_name('CLOCK')
-    clock = client[clock_name]
-    seq.ENABLE.put('ZERO')
-    seq.REPEATS.put(1)
-    seq.PRESCALE.put(0)
-    seq.BITA.put(f'{clock_name}.OUT')
-    seq.BITB.put('ZERO')
-    seq.BITC.put('ZERO')
-    seq.POSA.put('ZERO')
-    seq.POSB.put('ZERO')
-    seq.POSC.put('ZERO')
+    # the fields are put pipelined, instead of one round trip each
+    client.put_many({
+        f'{seq_name}.ENABLE': 'ZERO',
+        f'{seq_name}.REPEATS': 1,
+        f'{seq_name}.PRESCALE': 0,
+        f'{seq_name}.BITA': f'{clock_name}.OUT',
+        f'{seq_name}.BITB': 'ZERO',
+        f'{seq_name}.BITC': 'ZERO',
+        f'{seq_name}.POSA': 'ZERO',
+        f'{seq_name}.POSB': 'ZERO',
+        f'{seq_name}.POSC': 'ZERO',
+    })
     client.put_table(f'{seq_name}.TABLE', np.arange(0))
-    clock.ENABLE.put(f'{seq_name}.ACTIVE')
-    clock.ENABLE.DELAY.put(0)
-    clock.PERIOD.UNITS.put('s')
-    clock.WIDTH.UNITS.put('s')
-    clock.WIDTH.RAW=1
-    client.PCAP.ENABLE.put(f'{seq_name}.ACTIVE')
-    client.PCAP.ENABLE.DELAY.put(1)
-    client.PCAP.TRIG.put(f'{clock_name}.OUT')
-    client.PCAP.TRIG.DELAY.put(2)
-    client.PCAP.TRIG_EDGE.put('Rising')
-    client.PCAP.GATE.put('ONE')
-    client.PCAP.GATE.DELAY.put(0)
-    client.PCAP.SHIFT_SUM.put(0)
-    client.PCAP.TS_TRIG.CAPTURE.put('No')
-
-
-def handle_seq(args, allblocks, block_indexes, event):
-    client = PandaClient(args.host)
+    client.put_many({
+        f'{clock_name}.ENABLE': f'{seq_name}.ACTIVE',
+        f'{clock_name}.ENABLE.DELAY': 0,
+        f'{clock_name}.PERIOD.UNITS': 's',
+        f'{clock_name}.WIDTH.UNITS': 's',
+        f'{clock_name}.WIDTH.RAW': 1,
+        'PCAP.ENABLE': f'{seq_name}.ACTIVE',
+        'PCAP.ENABLE.DELAY': 1,
+        'PCAP.TRIG': f'{clock_name}.OUT',
+        'PCAP.TRIG.DELAY': 2,
+        'PCAP.TRIG_EDGE': 'Rising',
+        'PCAP.GATE': 'ONE',
+        'PCAP.GATE.DELAY': 0,
+        'PCAP.SHIFT_SUM': 0,
+        'PCAP.TS_TRIG.CAPTURE': 'No',
+    })
+
+
+def handle_seq(args, tables_shm, block_indexes, event):
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
     client.connect()
     seq_name = client.get_first_instance_name('SEQ')
     seq = client[seq_name]
@@ -73,58 +109,96 @@ def handle_seq(args, allblocks, block_indexes, event):
     seq.REPEATS.put(args.repeats)
     ticks = math.floor(args.clock_period_us * 1e-6 * args.fpga_freq)
     client[clock_name].PERIOD.RAW.put(ticks)
+    # each line waits for a clock pulse
+    line_period = ticks / args.fpga_freq
     streaming = args.nblocks > 1
     line = 0
+    contents, expected = get_tables(args, tables_shm)
+    # the same tables are pushed over and over, so each one is encoded once
+    encoded = {}
     for i in range(args.nblocks):
         t1 = time.time()
-        content, expected = allblocks[block_indexes[i]]
-        result = client.put_table(
-            f'{seq_name}.TABLE', content, streaming=(args.nblocks > 1),
+        index = block_indexes[i]
+        content = contents[index]
+        if index not in encoded:
+            encoded[index] = client.encode_table(content)
+
+        result = client.put_encoded_table(
+            f'{seq_name}.TABLE', encoded[index], streaming=streaming,
             last=(i == args.nblocks - 1))
         t2 = time.time()
         event.set()
-        print(f'seq {i}: took {t2 - t1:.3f}s to push table, '
-              f'line {line} , expected first value {expected[0]}')
+        log.debug('seq %d: took %.3fs to push table, line %d, '
+                  'expected first value %d', i, t2 - t1, line,
+                  expected[index, 0])
         line += len(content) // 4
         assert result.startswith(b'OK'), f'seq: error putting table: {result}'
-        while streaming and (seq.TABLE.QUEUED_LINES.get() >=
-                             args.max_blocks_queued * args.lines_per_block):
-            time.sleep(0.1)
+        # nothing else to push after the last table
+        if streaming and i < args.nblocks - 1:
+            wait_queue_below(seq.TABLE.QUEUED_LINES.get,
+                             args.max_blocks_queued * args.lines_per_block,
+                             line_period, args.poll_min_period,
+                             args.poll_max_period, args.poll_spins)
 
     client.close()
 
 
-def handle_pcap(args, checker_q, bits_word_num):
-    client = PandaClient(args.host)
-    client.connect()
-    client.disable_captures()
-    client.PCAP[f'BITS{bits_word_num}'].CAPTURE.put('Value')
-    client.arm()
+def get_tables(args, tables_shm):
+    # The 64 tables and the values expected from them live in shared memory,
+    # so all the workers map the same pages instead of each one getting its
+    # own copy
+    contents = np.ndarray((64, args.lines_per_block * 4), dtype=np.uint32,
+                          buffer=tables_shm.buf)
+    expected = np.ndarray((64, args.lines_per_block), dtype=np.uint32,
+                          buffer=tables_shm.buf, offset=contents.nbytes)
+    return contents, expected
+
+
+def get_pcap_slots(args, pcap_shm):
+    # Captured blocks are passed to the checkers in shared memory slots, only
+    # the slot index goes through the queues
+    return np.ndarray((args.pcap_slots, args.lines_per_block),
+                      dtype=np.uint32, buffer=pcap_shm.buf)
+
+
+def handle_pcap(args, checker_qs, free_qs, pcap_shm):
+    slots = get_pcap_slots(args, pcap_shm)
+    # the capture is armed by main, only the data connection is needed
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
     nvalues = 0
     nblock = 0
     t1 = time.time()
     # We receive a 32-bit word from BITSx for each line in a table
-    for data in client.collect(nbytes=args.lines_per_block * 4):
-        t2 = time.time()
-        checker_q.put((nblock, data))
-        t3 = time.time()
-        print(
-                f'pcap {nblock}: took {t2 - t1:.3f}s + {t3 - t2:.3f}s = '
-                f'{t3 - t1:.3f} ({len(data) // 4} lines)')
-        nvalues += len(data) // 4
-        nblock += 1
-        t1 = t2
+    try:
+        for data in client.collect(nbytes=args.lines_per_block * 4):
+            t2 = time.time()
+            nlines = len(data) // 4
+            # blocks are dealt to the checkers in turn, so each queue has a
+            # single producer and a single consumer and they never contend
+            checker_i = nblock % args.checker_threads
+            slot = free_qs[checker_i].get()
+            if slot is None:
+                raise RuntimeError(f'pcap: checker {checker_i} stopped')
+
+            slots[slot, :nlines] = np.frombuffer(data, dtype=np.uint32,
+                                                 count=nlines)
+            checker_qs[checker_i].put((nblock, slot, nlines))
+            t3 = time.time()
+            log.debug('pcap %d: took %.3fs + %.3fs = %.3f (%d lines)',
+                      nblock, t2 - t1, t3 - t2, t3 - t1, nlines)
+            nvalues += len(data) // 4
+            nblock += 1
+            t1 = t2
+    finally:
+        for checker_q in checker_qs:
+            # Signal the checker processes to stop
+            checker_q.put((None, None, None))
 
     print(f'pcap: received {nvalues} values')
 
-    for _ in range(args.checker_threads):
-        # Signal the checker processes to stop
-        checker_q.put((None, None))
-
     expected_lines = args.lines_per_block * args.nblocks * args.repeats
     assert expected_lines == nvalues, \
             f'pcap: expected {expected_lines} values, got {nvalues}'
-    client.close()
 
 
 def get_seq_offsets(client):
@@ -147,54 +221,158 @@ def get_seq_offsets(client):
     return word_num, offsets
 
 
-def checker(args, allblocks, block_indexes, checker_q, offsets):
-    while True:
-        nblock, data = checker_q.get()
-        if nblock is None:
-            break
-
-        adata = np.frombuffer(data, dtype=np.uint32)
-        _, expected = allblocks[block_indexes[nblock]]
-        print(f'checker {nblock}: Checking block ', end='')
-        print(f'line {nblock * args.lines_per_block}, ', end='')
-        print(f'expected start {expected[0]}')
-        assert len(adata) == len(expected)
-        vals = np.zeros(len(adata), dtype=np.uint32)
-        for off_i, off in enumerate(offsets):
-            vals |= ((adata >> off) & 1) << off_i
-
-        comp_result = vals == expected
-        if not comp_result.all():
-            i = np.where(~comp_result)[0][0]
-            assert vals[i] == expected[i], \
-                f'Got {vals[i]} expecting {expected[i]} at index {i}'
-
-
-def generate_content(args):
-    result = []
+def get_bit_runs(offsets):
+    # Group the output bit offsets into runs of consecutive bits, each run
+    # is moved with a single shift and mask (a software pext), so the usual
+    # layout with all the bits together takes a single shift and mask.
+    # The result has a column per run with its source shift, its mask and
+    # its destination shift
+    runs = []
+    for out_i, off in enumerate(offsets):
+        if runs and off == runs[-1][0] + runs[-1][1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([off, 1, out_i])
+
+    return np.array([[src, (1 << width) - 1, dst]
+                     for src, width, dst in runs],
+                    dtype=np.uint32).reshape(-1, 3).T.copy()
+
+
+# Types of the captured words, the expected values, the bit runs and the
+# output passed to gather_and_check
+CHECK_SIGNATURE = '(uint32[::1], uint32[::1], uint32[:, ::1], uint32[::1])'
+
+
+# Gather the sequencer output bits from each captured word into out and
+# count how many of them differ from the expected values
+if njit is not None:
+    # single fused pass over the words, releasing the GIL so that checker
+    # threads run alongside each other and the pcap thread. It isn't
+    # parallel, the threading layer can't run kernels from several threads
+    # at once and a block takes a fraction of the time it takes to capture
+    @njit(nogil=True, cache=True, boundscheck=False)
+    def gather_and_check(adata, expected, runs, out):
+        mismatches = 0
+        for i in range(adata.shape[0]):
+            word = adata[i]
+            val = 0
+            for run_i in range(runs.shape[1]):
+                val |= ((word >> runs[0, run_i]) & runs[1, run_i]) \
+                    << runs[2, run_i]
+
+            out[i] = val
+            if val != expected[i]:
+                mismatches += 1
+
+        return mismatches
+else:
+    # one vectorized pass per run, the ufuncs work in place on uint32 so
+    # they use NumPy's SIMD loops without temporaries, the first run is
+    # written straight into out, so the usual single run layout takes two
+    # passes
+    def gather_and_check(adata, expected, runs, out):
+        tmp = np.empty_like(out) if runs.shape[1] > 1 else None
+        for run_i, (src, mask, dst) in enumerate(runs.T):
+            dest = tmp if run_i else out
+            np.right_shift(adata, src, out=dest)
+            np.bitwise_and(dest, mask, out=dest)
+            if dst:
+                np.left_shift(dest, dst, out=dest)
+            if run_i:
+                np.bitwise_or(out, dest, out=out)
+
+        return np.count_nonzero(out != expected)
+
+
+def checker(args, tables_shm, block_indexes, checker_q, free_q, pcap_shm,
+            offsets):
+    _, all_expected = get_tables(args, tables_shm)
+    slots = get_pcap_slots(args, pcap_shm)
+    runs = get_bit_runs(offsets)
+    out = np.empty(args.lines_per_block, dtype=np.uint32)
+    try:
+        while True:
+            nblock, slot, nlines = checker_q.get()
+            if nblock is None:
+                break
+
+            adata = slots[slot, :nlines]
+            expected = all_expected[block_indexes[nblock]]
+            log.debug('checker %d: Checking block line %d, expected start %d',
+                      nblock, nblock * args.lines_per_block, expected[0])
+            assert len(adata) == len(expected)
+            vals = out[:len(adata)]
+            if gather_and_check(adata, expected, runs, vals):
+                # only locate the first mismatch when there is one
+                i = np.flatnonzero(vals != expected)[0]
+                raise AssertionError(
+                    f'Got {vals[i]} expecting {expected[i]} at index {i}')
+
+            free_q.put(slot)
+    finally:
+        # None in place of a free slot tells handle_pcap that the checker
+        # stopped, otherwise it could wait for a slot forever
+        free_q.put(None)
+
+
+def lcg_coefficients(n):
+    # coefficients such that the j-th value of the LCG seeded with x0 is
+    # (mult[j] * x0 + inc[j]) mod 2**31, the sequence length is doubled on
+    # each step as advancing k + i steps is advancing i steps after k
+    mask = np.uint64(0x7fffffff)
+    mult = np.ones(1, dtype=np.uint64)
+    inc = np.zeros(1, dtype=np.uint64)
+    while len(mult) < n:
+        mult_k = (mult[-1] * np.uint64(1103515245)) & mask
+        inc_k = (inc[-1] * np.uint64(1103515245) + np.uint64(12345)) & mask
+        inc = np.concatenate((inc, (mult * inc_k + inc) & mask))
+        mult = np.concatenate((mult, (mult * mult_k) & mask))
+
+    return mult[:n], inc[:n]
+
+
+# First word of a table line for each of the 64 possible values: 1 repeat,
+# triggered by BITA=1 and the value on the outputs
+FIRST_WORDS = np.uint32(0x20001) | (np.arange(64, dtype=np.uint32) << 20)
+
+
+# Write the values of each table and the table lines built from them
+if njit is not None:
+    # single pass over the tables, writing whole lines. It is not parallel,
+    # as it runs before forking the workers and the threading layer doesn't
+    # survive a fork
+    @njit(cache=True, boundscheck=False)
+    def pack_tables(mult, inc, out_ticks, vals, contents):
+        for block in range(vals.shape[0]):
+            seed = np.uint64(block)
+            for j in range(vals.shape[1]):
+                val = np.uint32((mult[j] * seed + inc[j]) & 0x3f)
+                vals[block, j] = val
+                contents[block, j, 0] = FIRST_WORDS[val]
+                contents[block, j, 1] = 0
+                contents[block, j, 2] = out_ticks
+                contents[block, j, 3] = 0
+else:
+    # one vectorized pass per column
+    def pack_tables(mult, inc, out_ticks, vals, contents):
+        seeds = np.arange(vals.shape[0], dtype=np.uint64)[:, np.newaxis]
+        vals[:] = (mult * seeds + inc) & 0x3f
+        contents[:, :, 0] = FIRST_WORDS[vals]
+        contents[:, :, 1] = 0
+        contents[:, :, 2] = out_ticks
+        contents[:, :, 3] = 0
+
+
+def generate_content(args, tables_shm):
     ticks = math.floor(args.clock_period_us * 1e-6 * args.fpga_freq)
     out_ticks = ticks // 2
-    for i in range(64):
-        content = np.zeros((args.lines_per_block * 4,), dtype=np.uint32)
-        expected = np.zeros((args.lines_per_block,), dtype=np.uint32)
-        val = i
-        rand = i
-        for j in range(args.lines_per_block):
-            w1 = 0x20001 | (val << 20)
-            w2 = 0
-            w3 = out_ticks
-            w4 = 0
-            content[j*4 + 0] = w1
-            content[j*4 + 1] = w2
-            content[j*4 + 2] = w3
-            content[j*4 + 3] = w4
-            expected[j] = val
-            rand = (rand * 1103515245 + 12345) & 0x7fffffff
-            val = rand & 0x3f
-
-        result.append((content, expected))
-
-    return result
+    # The values of each block come from an LCG seeded with the block
+    # number, all of them are evaluated at once with the closed form
+    mult, inc = lcg_coefficients(args.lines_per_block)
+    contents, vals = get_tables(args, tables_shm)
+    pack_tables(mult, inc, np.uint32(out_ticks), vals,
+                contents.reshape(64, args.lines_per_block, 4))
 
 
 def print_stats(args):
@@ -207,40 +385,107 @@ def print_stats(args):
     print(f'Total size: {args.lines_per_block * args.nblocks * 16 / 1024**2:.3f} MiB')
 
 
-def main():
-    args = parse_args()
-    allblocks = generate_content(args)
-    block_indexes = np.array(
-        [random.randint(0, 63) for _ in range(args.nblocks)], dtype=np.uint8)
+def get_cpus_by_core():
+    # The CPUs we can run on, with one SMT sibling of each core before the
+    # rest, so that workers only share a core when there are more workers
+    # than cores
+    first, rest = [], []
+    cores = set()
+    for cpu in sorted(os.sched_getaffinity(0)):
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/'
+                      'thread_siblings_list') as f:
+                core = f.read().strip()
+        except OSError:
+            core = str(cpu)
+
+        if core in cores:
+            rest.append(cpu)
+        else:
+            cores.add(core)
+            first.append(cpu)
+
+    return first + rest
+
+
+def pin_workers(workers):
+    # The stages (pushing tables, receiving captures and checking them) are
+    # bound by memory copies and IPC rather than by computation, keeping
+    # each one on its own core keeps its data in that core's caches
+    if not hasattr(os, 'sched_setaffinity'):
+        log.warning('CPU affinity is not supported on this platform')
+        return
+
+    cpus = get_cpus_by_core()
+    for i, worker in enumerate(workers):
+        worker_id = getattr(worker, 'pid', None) or worker.native_id
+        os.sched_setaffinity(worker_id, {cpus[i % len(cpus)]})
+
+
+def run(args, tables_shm, pcap_shm):
+    generate_content(args, tables_shm)
+    rng = np.random.default_rng(args.seed)
+    block_indexes = rng.integers(0, 64, size=args.nblocks, dtype=np.uint8)
     print_stats(args)
-    client = PandaClient(args.host)
+    if njit is not None:
+        # compiling the checking kernel mid-stream takes longer than the pcap
+        # slots can buffer, so it is compiled, or loaded from the cache,
+        # before arming and the workers inherit it
+        gather_and_check.compile(CHECK_SIGNATURE)
+
+    client = PandaClient(args.host, busy_poll_us=args.busy_poll_us)
     client.connect()
     configure_layout(client)
     seq_bits, seq_offsets = get_seq_offsets(client)
-    checker_q = multiprocessing.Queue(16)
-    produced = multiprocessing.Event()
+    # arm here, on the connection that is already open, so the workers
+    # that only collect data don't need a control connection of their own
+    client.disable_captures()
+    client.PCAP[f'BITS{seq_bits}'].CAPTURE.put('Value')
+    client.arm()
+    # every queue has a single producer and a single consumer and is bounded
+    # by the number of slots, so the simple queues are enough, without the
+    # feeder thread of multiprocessing.Queue
+    if args.workers == 'threads':
+        Worker, Event = threading.Thread, threading.Event
+        Queue = queue.SimpleQueue
+    else:
+        Worker, Event = multiprocessing.Process, multiprocessing.Event
+        Queue = multiprocessing.SimpleQueue
+
+    checker_qs = [Queue() for _ in range(args.checker_threads)]
+    free_qs = [Queue() for _ in range(args.checker_threads)]
+    for slot in range(args.pcap_slots):
+        free_qs[slot % args.checker_threads].put(slot)
+
+    produced = Event()
     procs = []
     procs.append(
-        multiprocessing.Process(target=handle_seq, args=(args,
-                                                         allblocks,
-                                                         block_indexes,
-                                                         produced)))
+        Worker(target=handle_seq, args=(args,
+                                        tables_shm,
+                                        block_indexes,
+                                        produced)))
     procs.append(
-        multiprocessing.Process(target=handle_pcap, args=(args,
-                                                          checker_q,
-                                                          seq_bits)))
+        Worker(target=handle_pcap, args=(args,
+                                         checker_qs,
+                                         free_qs,
+                                         pcap_shm)))
 
-    for _ in range(args.checker_threads):
+    for checker_q, free_q in zip(checker_qs, free_qs):
         procs.append(
-            multiprocessing.Process(target=checker, args=(args,
-                                                          allblocks,
-                                                          block_indexes,
-                                                          checker_q,
-                                                          seq_offsets)))
+            Worker(target=checker, args=(args,
+                                         tables_shm,
+                                         block_indexes,
+                                         checker_q,
+                                         free_q,
+                                         pcap_shm,
+                                         seq_offsets)))
 
     for proc in procs:
         proc.start()
 
+    if args.pin_cpus:
+        pin_workers(procs)
+
     # Wait for handle_seq to have a table
     produced.wait()
     time.sleep(0.5)
@@ -258,5 +503,30 @@ def main():
     client.close()
 
 
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+
+    # the tables and then the expected values, see get_tables
+    tables_shm = shared_memory.SharedMemory(
+        create=True, size=64 * args.lines_per_block * 20)
+    # shared memory outlives the process unless it is unlinked, so it is
+    # unlinked however the run ends, before closing it, as closing fails
+    # while the arrays of a failed run still map it
+    try:
+        pcap_shm = shared_memory.SharedMemory(
+            create=True, size=args.pcap_slots * args.lines_per_block * 4)
+        try:
+            run(args, tables_shm, pcap_shm)
+        finally:
+            pcap_shm.unlink()
+            pcap_shm.close()
+    finally:
+        tables_shm.unlink()
+        tables_shm.close()
+
+
 if __name__ == '__main__':
     main()
@@ -46,22 +46,37 @@ class TuiManager:
 
         self.win.addstr(y, x, string.encode())
         self.line += 1
-        self.win.refresh()
+
+    def flush(self):
+        # the screen is updated once after drawing, instead of once per string
+        self.win.noutrefresh()
+        curses.doupdate()
 
     def reset_line(self):
         self.line = 0
 
-    def process_events(self):
+    def process_events(self, timeout=0):
+        # wait up to timeout seconds for the first event, curses stops waiting
+        # as soon as the terminal is resized, unlike a select on stdin, then
+        # handle every pending event without waiting
+        self.win.timeout(int(timeout * 1000))
         c = self.win.getch()
-        if c == curses.KEY_RESIZE:
-            self.on_resize()
-            self.notify_draw()
-        if c != -1:
+        self.win.nodelay(1)
+        while c != -1:
+            if c == curses.KEY_RESIZE:
+                self.on_resize()
+                self.notify_draw()
             self.notify_key(c)
+            c = self.win.getch()
 
     def clear(self):
         self.win.clear()
 
+    def erase(self):
+        # unlike clear, the terminal isn't cleared on the next refresh, so
+        # curses only sends the parts of the screen that changed
+        self.win.erase()
+
     def quit(self):
         curses.echo()
         curses.nocbreak()
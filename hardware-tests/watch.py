@@ -3,7 +3,7 @@ import argparse
 import time
 
 from tui import TuiManager
-from panda import PandaClient
+from panda import PandaClient, parse_value
 
 
 def parse_args():
@@ -30,20 +30,27 @@ def main():
 
     tui = TuiManager()
     def draw():
-        tui.clear()
+        # get all the fields pipelined, in a single round trip
+        results = client.send_recv_many([f'{field.path}?' for field in fields])
+        tui.erase()
         tui.reset_line()
-        for field in fields:
+        for field, result in zip(fields, results):
             try:
-                tui.add_str(f'{field.path}: {field.get()}')
+                tui.add_str(f'{field.path}: {parse_value(field.path, result)}')
             except ValueError as e:
                 tui.add_str(f'{field.path}: {str(e)}')
 
+        tui.flush()
+
     tui.add_draw_callback(draw)
     while True:
         draw()
-        tui.process_events()
+        # handle key presses and resizes as soon as they come while waiting
+        # for the next redraw, instead of sleeping through them
+        deadline = time.monotonic() + args.watch_period
         try:
-            time.sleep(args.watch_period)
+            while (timeout := deadline - time.monotonic()) > 0:
+                tui.process_events(timeout)
         except KeyboardInterrupt:
             break
 
@@ -17,6 +17,19 @@ TOP = SCRIPT_DIR.parent
 Dut = cocotb.handle.HierarchyObject
 SignalsInfo = dict[str, dict[str, str | int]]
 
+TEST_NAME_TRANSLATION = str.maketrans({" ": "_", "/": "_"})
+
+
+def sanitize_test_name(test_name: str) -> str:
+    """Make a test name usable in file names.
+
+    Args:
+        test_name: Name of test.
+    Returns:
+        Test name with spaces and slashes replaced by underscores.
+    """
+    return test_name.translate(TEST_NAME_TRANSLATION)
+
 
 def read_ini(path: list[str] | str) -> ConfigParser:
     """Read INI file and return its contents.
@@ -438,7 +451,7 @@ def collect_values(values: dict[int, dict[str, tuple[int, int]]], test_name: str
         values: Dictionary of signal values to save.
         test_name: Name of test.
     """
-    filename = f'{test_name.replace(' ', '_').replace('/', '_')}_values'
+    filename = f'{sanitize_test_name(test_name)}_values'
     values_df = pd.DataFrame(values)
     values_df = values_df.transpose()
     values_df.index.name = "tick"
@@ -483,7 +496,7 @@ async def section_timing_test(
     )
 
     if timing_errors:
-        filename = f'{test_name.replace(' ', '_').replace('/', '_')}_errors.csv'
+        filename = f'{sanitize_test_name(test_name)}_errors.csv'
         with open(filename, mode="w", newline="", encoding="utf-8") as file:
             writer = csv.writer(file)
             for tick, messages in timing_errors.items():
@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 import argparse
+import copy
 import csv
+import hashlib
+import importlib.util
 import logging
 import os
+import pickle
 import shutil
 import subprocess
 import time
+from concurrent.futures import (Future, ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 from configparser import ConfigParser
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Any, List
 
-from cocotb_simulate_test import get_block_ini
+from cocotb_simulate_test import get_block_ini, sanitize_test_name
 from cocotb_tools import runner  # type: ignore
 
 logger = logging.getLogger(__name__)
@@ -18,6 +25,10 @@ logger = logging.getLogger(__name__)
 SCRIPT_DIR = Path(__file__).parent.resolve()
 TOP = SCRIPT_DIR.parent
 WORKING_DIR = Path.cwd()
+# Outside the simulation build directories, which are cleaned on every build
+ORDER_CACHE_DIR = WORKING_DIR / "vhdeps_cache"
+# Only used to centre headings, so it is not updated if the terminal resizes
+TERMINAL_COLUMNS = shutil.get_terminal_size().columns
 
 
 def get_args():
@@ -29,6 +40,9 @@ def get_args():
     parser.add_argument("--panda-src", default="/src")
     parser.add_argument("--panda-build-dir", default="/build")
     parser.add_argument("-c", action="store_true")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reuse a module's last build if its sources and "
+                        "build arguments haven't changed")
     return parser.parse_args()
 
 
@@ -67,24 +81,80 @@ def block_has_dma(block_ini: ConfigParser) -> bool:
     return block_ini["."].get("type", "") == "dma"
 
 
+def load_test_config(module: str, panda_src: str | Path) -> SimpleNamespace:
+    """Load a module's test config file.
+
+    Args:
+        module: Name of module.
+        panda_src: Path to the PandA FPGA source, used as TOP by the config.
+    Returns:
+        The EXTRA_BUILD_ARGS and EXTRA_HDL_FILES of the config, empty if the
+        module doesn't have one.
+    """
+    test_config_path = SCRIPT_DIR / f'{module}_test_config.py'
+    if not test_config_path.exists():
+        return SimpleNamespace(EXTRA_BUILD_ARGS=[], EXTRA_HDL_FILES=[])
+    spec = importlib.util.spec_from_file_location(
+        f'{module}_test_config', test_config_path)
+    assert spec is not None and spec.loader is not None
+    config_module = importlib.util.module_from_spec(spec)
+    # The config refers to these without importing them
+    config_module.TOP = Path(panda_src)  # type: ignore
+    config_module.EXTRA = TOP / "hdl"  # type: ignore
+    spec.loader.exec_module(config_module)
+    return SimpleNamespace(
+        EXTRA_BUILD_ARGS=list(getattr(config_module, "EXTRA_BUILD_ARGS", [])),
+        EXTRA_HDL_FILES=list(getattr(config_module, "EXTRA_HDL_FILES", [])),
+    )
+
+
 def get_module_build_args(module: str, panda_src: str | Path,
-                          panda_build_dir: str | Path) -> list[str]:
+                          panda_build_dir: str | Path,
+                          config: SimpleNamespace | None = None) -> list[str]:
     """Get simulation build arguments from a module's test config file.
 
     Args:
         module: Name of module.
         panda_build_dir: Path to autogenerated HDL files.
+        config: The module's test config, if already loaded.
     Returns:
         List of extra build arguments.
     """
-    test_config_path = SCRIPT_DIR / f'{module}_test_config.py'
-    if test_config_path.exists():
-        g = {"TOP": Path(panda_src), "EXTRA": TOP / "hdl"}
-        code = open(str(test_config_path)).read()
-        exec(code, g)
-        args: list[str] = g.get("EXTRA_BUILD_ARGS", [])  # type: ignore
-        return args
-    return []
+    if config is None:
+        config = load_test_config(module, panda_src)
+    return list(config.EXTRA_BUILD_ARGS)
+
+
+def get_files_fingerprint(files: list[Path], *extra: str) -> str | None:
+    """Hash a set of files by their paths and modification times.
+
+    Args:
+        files: List of files.
+        extra: Anything else the hash should depend on.
+    Returns:
+        Hex digest of the hash, None if a file is missing.
+    """
+    try:
+        stats = sorted((str(file), file.stat().st_mtime_ns) for file in files)
+    except OSError:
+        return None
+    return hashlib.blake2b(
+        repr((stats, extra)).encode(), digest_size=16
+    ).hexdigest()
+
+
+def get_order_cache_paths(top_level: str) -> tuple[Path, Path]:
+    """Get where the compilation order of a top level entity is cached.
+
+    Args:
+        top_level: Name of the top-level entity.
+    Returns:
+        Paths to the cached order file and to the fingerprint of the files it
+        was generated from. There is one per top level, so a new order
+        replaces the last one.
+    """
+    return (ORDER_CACHE_DIR / f"{top_level}.order",
+            ORDER_CACHE_DIR / f"{top_level}.fingerprint")
 
 
 def order_hdl_files(
@@ -109,11 +179,31 @@ def order_hdl_files(
         command.append(f"--include={str(file)}")
     command_str = " ".join(command)
     Path(WORKING_DIR / build_dir).mkdir(exist_ok=True)
-    subprocess.run(["/usr/bin/env"] + command)
+    order_path = WORKING_DIR / build_dir / "order"
+    cached_order_path, fingerprint_path = get_order_cache_paths(top_level)
+    fingerprint = get_files_fingerprint(hdl_files, top_level)
+    if (
+        fingerprint is not None
+        and fingerprint_path.is_file()
+        and fingerprint_path.read_text() == fingerprint
+        and cached_order_path.exists()
+    ):
+        logger.info(f"Reusing compilation order from {cached_order_path}")
+        shutil.copyfile(cached_order_path, order_path)
+    else:
+        completed = subprocess.run(["/usr/bin/env"] + command)
+        if completed.returncode == 0 and fingerprint is not None:
+            ORDER_CACHE_DIR.mkdir(exist_ok=True)
+            # The fingerprint is only there while it matches the order, so
+            # an interrupted copy isn't reused
+            fingerprint_path.unlink(missing_ok=True)
+            shutil.copyfile(order_path, cached_order_path)
+            fingerprint_path.write_text(fingerprint)
     try:
         with open(Path(build_dir) / "order") as order:
+            # The path is the last field of each line
             ordered_hdl_files = [
-                Path(line.strip().split(" ")[-1]) for line in order.readlines()
+                Path(line.rstrip().rpartition(" ")[2]) for line in order
             ]
         return ordered_hdl_files
     except FileNotFoundError as error:
@@ -125,7 +215,8 @@ def order_hdl_files(
 
 def get_module_hdl_files(
         module: str, module_top_level: Path, panda_src: str | Path,
-        build_dir: str | Path, panda_build_dir: str | Path
+        build_dir: str | Path, panda_build_dir: str | Path,
+        config: SimpleNamespace | None = None
 ):
     """Get HDL files needed to simulate a module from its test config file.
 
@@ -134,25 +225,34 @@ def get_module_hdl_files(
         top_level: Top level entity of module being tested.
         build_dir: Name of simulation build directory.
         panda_build_dir: Path to autogenerated HDL files.
+        config: The module's test config, if already loaded.
     Returns:
         List of paths to the HDL files.
     """
-    test_config_path = SCRIPT_DIR / f'{module}_test_config.py'
-    g = {"TOP": Path(panda_src), "EXTRA": TOP / "hdl"}
-    if test_config_path.exists():
-        code = open(str(test_config_path)).read()
-        exec(code, g)
-        g.get("EXTRA_HDL_FILES", [])
-        extra_files: list[Path] = list(g.get("EXTRA_HDL_FILES", []))  # type: ignore
-        extra_files_2: list[Path] = []
-        for my_file in extra_files:
-            if str(my_file).endswith(".vhd"):
-                extra_files_2.append(my_file)
-            else:
-                extra_files_2 = extra_files_2 + list(my_file.glob("**/*.vhd"))
-    else:
-        extra_files_2 = []
-    result = extra_files_2 + list((Path(panda_src) / "modules" / module / "hdl").glob("*.vhd"))
+    if config is None:
+        config = load_test_config(module, panda_src)
+    candidates: list[Path] = []
+    for my_file in config.EXTRA_HDL_FILES:
+        if str(my_file).endswith(".vhd"):
+            candidates.append(my_file)
+        else:
+            # One walk of the tree, only creating paths for VHDL files,
+            # following symlinked directories as the recursive glob did
+            for root, _, files in os.walk(my_file, followlinks=True):
+                candidates.extend(
+                    Path(root, name) for name in files
+                    if name.endswith(".vhd")
+                )
+    candidates.extend(
+        (Path(panda_src) / "modules" / module / "hdl").glob("*.vhd"))
+    # A file may be both listed and found in a listed directory
+    seen: set[Path] = set()
+    result: list[Path] = []
+    for my_file in candidates:
+        resolved = my_file.resolve()
+        if resolved not in seen:
+            seen.add(resolved)
+            result.append(my_file)
     ordered = order_hdl_files(result, build_dir, module_top_level)
     logger.info("Gathering the following VHDL files:")
     for my_file in ordered:
@@ -202,13 +302,15 @@ def summarise_results(results: dict[str, list[list[str]]]):
     Args:
         Results: Dictionary of all results from a test run.
     """
-    failed: list[str] = [module for module in results if results[module][1]]
-    passed: list[str] = [module for module in results if not results[module][1]]
+    failed: list[str] = []
+    passed: list[str] = []
     total_passed, total_failed = 0, 0
-    for module in results:
-        total_passed += len(results[module][0])
-        total_failed += len(results[module][1])
+    for module, (module_passed, module_failed) in results.items():
+        (failed if module_failed else passed).append(module)
+        total_passed += len(module_passed)
+        total_failed += len(module_failed)
     total = total_passed + total_failed
+    n_modules = len(results)
     print("\nSummary:\n")
     if total == 0:
         print("\033[1;33m" + "No tests ran." + "\033[0m")
@@ -216,8 +318,8 @@ def summarise_results(results: dict[str, list[list[str]]]):
         print(
             "{}/{} modules passed ({}%).".format(
                 len(passed),
-                len(results.keys()),
-                round(len(passed) / len(results.keys()) * 100),
+                n_modules,
+                round(len(passed) / n_modules * 100),
             )
         )
         print(
@@ -263,7 +365,7 @@ def get_test_args(simulator: str, build_args: list[str], test_name: str) -> list
     Returns:
         List of test arguments.
     """
-    test_name = test_name.replace(" ", "_").replace("/", "_")
+    test_name = sanitize_test_name(test_name)
     if simulator == "ghdl":
         return build_args
     elif simulator == "nvc":
@@ -295,7 +397,7 @@ def get_plusargs(simulator: str, test_name: str) -> list[str]:
 
     Returns:
     """
-    test_name = test_name.replace(" ", "_").replace("/", "_")
+    test_name = sanitize_test_name(test_name)
     vcd_filename = f"{test_name}.vcd"
     if simulator == "ghdl":
         return [f"--vcd={vcd_filename}"]
@@ -304,8 +406,34 @@ def get_plusargs(simulator: str, test_name: str) -> list[str]:
     return []
 
 
+def copy_build(simulator: str, build_dir: str | Path, test_dir: str | Path):
+    """Copy what a test needs from the module's build into the directory it
+    runs in.
+
+    Args:
+        simulator: Name of simulator being used.
+        build_dir: Simulation build directory of the module.
+        test_dir: Directory the test will run in.
+    """
+    if simulator == "ghdl":
+        # ghdl keeps the library index, and the objects and executable when
+        # it generates code, in the build directory itself, next to the
+        # directories holding the files of tests already run
+        os.makedirs(WORKING_DIR / test_dir)
+        with os.scandir(WORKING_DIR / build_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    shutil.copy2(entry.path, WORKING_DIR / test_dir)
+    elif simulator == "nvc":
+        shutil.copytree(WORKING_DIR / build_dir / "top",
+                        WORKING_DIR / test_dir / "top")
+    else:
+        raise NotImplementedError(f"{simulator} is not a valid simulator")
+
+
 def collect_coverage_file(
-    build_dir: str | Path, top_level: str, test_name: str
+    build_dir: str | Path, top_level: str, test_name: str,
+    test_dir: str | Path | None = None
 ) -> Path:
     """Move coverage file to the coverage directory
 
@@ -313,85 +441,103 @@ def collect_coverage_file(
         build_dir: Simulation build directory.
         top_level: Top level entity being tested.
         test_name: Name of test being carried out.
+        test_dir: Directory the test ran in, if not the build directory.
     Returns:
         New file path of the coverage file.
     """
     coverage_path = Path(WORKING_DIR / build_dir / "coverage")
     Path(coverage_path).mkdir(exist_ok=True)
     old_file_path = Path(
-        WORKING_DIR / build_dir / "top" / f"_TOP.{top_level.upper()}.elab.covdb"
+        WORKING_DIR / (test_dir or build_dir) / "top"
+        / f"_TOP.{top_level.upper()}.elab.covdb"
     )
-    test_name = test_name.replace(" ", "_").replace("/", "_")
+    test_name = sanitize_test_name(test_name)
     new_file_path = Path(
         coverage_path / f"_TOP.{top_level.upper()}.{test_name}.elab.covdb"
     )
-    subprocess.run(["mv", old_file_path, new_file_path])
+    try:
+        os.replace(old_file_path, new_file_path)
+    except FileNotFoundError:
+        logger.warning(f"No coverage file found at {old_file_path}")
+    except OSError:
+        # os.replace can't move across filesystems
+        shutil.move(old_file_path, new_file_path)
     return new_file_path
 
 
-def merge_coverage_data(
-    build_dir: str | Path, module: str, file_paths: list[Path]
-) -> Path:
-    """Merges coverage files from each test to create an overall coverage
-    report for a module.
+def start_nvc(command: list[str]) -> "subprocess.Popen[str]":
+    """Start an nvc command with its output captured, so that it can run
+    alongside others without mixing up what they print.
 
     Args:
-        build_dir: Simulation build directory.
-        module: Name of module.
-        file_paths: List of paths to coverage files from each test.
+        command: nvc command line.
     Returns:
-        File path for the coverage report file.
+        The running process.
     """
-    merged_path = Path(WORKING_DIR / build_dir / "coverage" / f"merged.{module}.covdb")
-    command = (
-        ["nvc", "--cover-merge", "-o"]
-        + [str(merged_path)]
-        + [str(file_path) for file_path in file_paths]
+    return subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
     )
-    subprocess.run(command)
-    return merged_path
+
+
+def print_nvc_output(process: "subprocess.Popen[str]"):
+    """Wait for an nvc command started by start_nvc and print its output.
+
+    Args:
+        process: The running process.
+    """
+    output, _ = process.communicate()
+    print(output, end="")
 
 
 def export_coverage_data(
     output_path: Path,
     file_paths: list[Path],
     format: str = "cobertura",
-):
-    """Merges merge coverage files from each module to create an overall coverage
-    report in an xml format suitable for codecov.
+) -> "subprocess.Popen[str]":
+    """Start merging coverage files from every test to create an overall
+    coverage report in an xml format suitable for codecov.
 
     Args:
         output_path: Path of the output coverage report to write
-        file_paths: List of Paths to coverage files from each module.
+        file_paths: List of Paths to coverage files from each test.
         format: coverage format to pass to nvc simulator
+    Returns:
+        The running nvc process, see print_nvc_output.
     """
     command = (
         ["nvc", "--cover-export", f"--format={format}", "-o"]
         + [str(output_path)]
         + [str(file_path) for file_path in file_paths]
     )
-    subprocess.run(command)
+    return start_nvc(command)
 
 
-def cleanup_dir(test_name: str, build_dir: str | Path):
+def cleanup_dir(test_name: str, build_dir: str | Path,
+                test_dir: str | Path | None = None):
     """Creates a subdirectory for a test and moves all files generated from
     that test into it.
 
     Args:
         test_name: Name of test.
         build_dir: Simulation build directory.
+        test_dir: Directory the test ran in, if not the build directory.
     """
-    test_name = test_name.replace(" ", "_").replace("/", "_")
-    (WORKING_DIR / build_dir / test_name).mkdir(exist_ok=True)
-    logger.info(f'Putting all files related to "{test_name}" in {str(
-        WORKING_DIR / build_dir / test_name)}')
-    for file in (WORKING_DIR / build_dir).glob(f"{test_name}*"):
-        if file.is_file():
-            new_name = str(file).split("/")[-1].replace(test_name, "")
-            if new_name.endswith(".vcd"):
-                new_name = "wave" + new_name
-            new_name = new_name.lstrip("_")
-            file.rename(WORKING_DIR / build_dir / test_name / new_name)
+    test_name = sanitize_test_name(test_name)
+    test_files_dir = os.path.join(WORKING_DIR, build_dir, test_name)
+    os.makedirs(test_files_dir, exist_ok=True)
+    logger.info(f'Putting all files related to "{test_name}" in {test_files_dir}')
+    # Entries are listed before moving any, rather than renaming mid scan
+    with os.scandir(WORKING_DIR / (test_dir or build_dir)) as it:
+        entries = [
+            entry for entry in it
+            if entry.name.startswith(test_name) and entry.is_file()
+        ]
+    for entry in entries:
+        new_name = entry.name.replace(test_name, "")
+        if new_name.endswith(".vcd"):
+            new_name = "wave" + new_name
+        new_name = new_name.lstrip("_")
+        os.replace(entry.path, os.path.join(test_files_dir, new_name))
 
 
 def print_errors(failed_tests: list[str], build_dir: str | Path):
@@ -403,29 +549,39 @@ def print_errors(failed_tests: list[str], build_dir: str | Path):
     """
     for test_name in failed_tests:
         logger.info(f'        See timing errors for "{test_name}" below')
-        test_name = test_name.replace(" ", "_").replace("/", "_")
+        test_name = sanitize_test_name(test_name)
         with open(WORKING_DIR / build_dir / test_name / "errors.csv") as file:
-            reader = csv.reader(file)
-            for row in reader:
-                log_timing_error(row[1])
+            messages = [row[1] for row in csv.reader(file)]
+        # One log record for all of a test's errors, there can be thousands
+        if messages:
+            log_timing_error("\n".join(messages))
+
+
+def start_coverage_report(file_paths: list[Path]) -> "subprocess.Popen[str]":
+    """Start generating a coverage report, merged from the coverage files
+    given.
+
+    Args:
+        file_paths: List of paths to a module's coverage files from each test.
+    Returns:
+        The running nvc process, see print_coverage_data.
+    """
+    coverage_path = file_paths[0].parent
+    command = (
+        ["nvc", "--cover-report", "-o", str(coverage_path)]
+        + [str(file_path) for file_path in file_paths]
+    )
+    return start_nvc(command)
 
 
-def print_coverage_data(coverage_report_path: Path):
+def print_coverage_data(report: "subprocess.Popen[str]"):
     """Print coverage report
 
     Args:
-        coverage_report_path: Path to coverage report file.
+        report: nvc process started by start_coverage_report.
     """
     print("Code coverage:")
-    coverage_path = coverage_report_path.parent
-    command = [
-        "nvc",
-        "--cover-report",
-        "-o",
-        str(coverage_path),
-        str(coverage_report_path),
-    ]
-    subprocess.run(command)
+    print_nvc_output(report)
 
 
 def log_timing_error(message: str, *args: Any, **kwargs: Any):
@@ -435,6 +591,69 @@ def log_timing_error(message: str, *args: Any, **kwargs: Any):
     #    logger.error(message, *args, **kwargs)
 
 
+def run_section_test(
+    built_sim: "runner.Simulator",
+    module: str,
+    test_name: str,
+    timing_ini_path: str,
+    simulator: str,
+    build_dir: str | Path,
+    build_args: list[str],
+    panda_src: str | Path,
+    panda_build_dir: str | Path,
+    collect: bool,
+) -> tuple[tuple[int, int], Path | None]:
+    """Run one test from a timing INI file in a copy of the module's build.
+
+    Args:
+        built_sim: Simulator runner the module was built with.
+        module: Name of module.
+        test_name: Name of the INI section to test.
+        timing_ini_path: Path to the timing INI file containing the test.
+        simulator: Name of simulator to use for simulation.
+        build_dir: Simulation build directory of the module.
+        build_args: Arguments used for the build stage.
+        panda_build_dir: Location of autogenerated HDL files.
+        collect: If True, collect output signals expected and actual values.
+    Returns:
+        Number of tests ran and failed, path to the test's coverage file.
+    """
+    # A runner keeps the state of the test it is running, so each thread
+    # needs its own, copied to keep what the build set up
+    sim: runner.Simulator = copy.copy(built_sim)  # type: ignore
+    top_level = module
+    test_dir = f"{build_dir}_{sanitize_test_name(test_name)}"
+    shutil.rmtree(WORKING_DIR / test_dir, ignore_errors=True)
+    copy_build(simulator, build_dir, test_dir)
+    xml_path: Path = sim.test(  # type: ignore
+        hdl_toplevel=top_level,
+        test_module="cocotb_simulate_test",
+        build_dir=test_dir,
+        test_args=get_test_args(simulator, build_args, test_name),
+        elab_args=get_elab_args(simulator),
+        plusargs=get_plusargs(simulator, test_name),
+        extra_env={
+            "module": module,
+            "test_name": test_name,
+            "simulator": simulator,
+            "sim_build_dir": str(test_dir),
+            "timing_ini_path": str(timing_ini_path),
+            "panda_src_dir": str(panda_src),
+            "panda_build_dir": str(panda_build_dir),
+            "collect": str(collect),
+        },
+    )
+    results: tuple[int, int] = runner.get_results(xml_path)  # type: ignore
+    coverage_file_path = None
+    if simulator == "nvc":
+        coverage_file_path = collect_coverage_file(
+            build_dir, top_level, test_name, test_dir
+        )
+    cleanup_dir(test_name, build_dir, test_dir)
+    shutil.rmtree(WORKING_DIR / test_dir)
+    return results, coverage_file_path
+
+
 def test_module(
     module: str,
     test_name: str | None = None,
@@ -442,7 +661,9 @@ def test_module(
     panda_src: str | Path = "/src",
     panda_build_dir: str | Path = "/build",
     collect: bool = False,
-) -> tuple[list[str], list[str], Path | None]:
+    incremental: bool = False,
+    max_simulations: int | None = None,
+) -> tuple[list[str], list[str], list[Path]]:
     """Run tests for a module.
 
     Args:
@@ -452,88 +673,127 @@ def test_module(
         simulator: Name of simulator to use for simulation.
         panda_build_dir: Location of autogenerated HDL files.
         collect: If True, collect output signals expected and actual values.
+        incremental: If True, don't build again when the sources and build
+            arguments are the same as the last build.
+        max_simulations: Number of tests simulated at the same time, one per
+            CPU if not specified.
     Returns:
-        Lists of tests that passed and failed respectively, path to coverage.
+        Lists of tests that passed and failed respectively, and of paths to
+        each test's coverage file.
     """
     sim: runner.Simulator = runner.get_runner(simulator)  # type: ignore
     build_dir = f"sim_build_{module}"
     build_args = get_simulator_build_args(simulator)
-    build_args += get_module_build_args(module, panda_src, panda_build_dir)
+    # Loaded once for both the build arguments and the HDL files
+    config = load_test_config(module, panda_src)
+    build_args += get_module_build_args(module, panda_src, panda_build_dir,
+                                        config)
     top_level = module
-    sim.build(  # type: ignore
-        sources=get_module_hdl_files(module, top_level, panda_src, build_dir,
-                                     panda_build_dir),
-        build_dir=build_dir,
-        hdl_toplevel=top_level,
-        build_args=build_args,
-        clean=True,
+    sources = get_module_hdl_files(module, top_level, panda_src, build_dir,
+                                   panda_build_dir, config)
+    # The runner is kept with the build, so a new cocotb means a new build
+    fingerprint = get_files_fingerprint(
+        sources + [Path(runner.__file__)], simulator, top_level, *build_args
+    )
+    fingerprint_path = WORKING_DIR / build_dir / ".build_fingerprint"
+    built_sim_path = WORKING_DIR / build_dir / ".build_runner"
+    up_to_date = (
+        incremental
+        and fingerprint is not None
+        and fingerprint_path.is_file()
+        and built_sim_path.is_file()
+        and fingerprint_path.read_text() == fingerprint
     )
+    if up_to_date:
+        logger.info(f"Sources of {module} unchanged, reusing {build_dir}")
+        # The nvc and ghdl runners analyse every source on each build, so
+        # instead the runner is restored as the last build left it, with the
+        # state its tests rely on
+        with open(built_sim_path, "rb") as f:
+            sim = pickle.load(f)
+    else:
+        sim.build(  # type: ignore
+            sources=sources,
+            build_dir=build_dir,
+            hdl_toplevel=top_level,
+            build_args=build_args,
+            clean=True,
+        )
+        if fingerprint is not None:
+            with open(built_sim_path, "wb") as f:
+                pickle.dump(sim, f)
+            fingerprint_path.write_text(fingerprint)
     passed: list[str] = []
     failed: list[str] = []
     coverage_file_paths: list[Path] = []
-    coverage_report_path: Path | None = None
 
     timing_inis = get_timing_inis(panda_src, module)
-    for path, timing_ini in timing_inis.items():
-        if test_name:
-            sections: list[str] = []
-            for test in test_name.split(",,"):  # Some test names contain a comma
-                if test in timing_ini.sections():
-                    sections.append(test)
-                else:
-                    print(
-                        'No test called "{}" in {} INI timing file.'.format(
-                            test, module
-                        ).center(shutil.get_terminal_size().columns)
+    # Each test runs in its own copy of the build, so the simulator processes
+    # can run side by side without writing over each other's files
+    futures: list[tuple[str, Future[tuple[tuple[int, int], Path | None]]]] = []
+    with ThreadPoolExecutor(
+        max_workers=max_simulations or os.cpu_count()
+    ) as executor:
+        for path, timing_ini in timing_inis.items():
+            if test_name:
+                sections: list[str] = []
+                for test in test_name.split(",,"):  # Some test names contain a comma
+                    if test in timing_ini.sections():
+                        sections.append(test)
+                    else:
+                        print(
+                            'No test called "{}" in {} INI timing file.'.format(
+                                test, module
+                            ).center(TERMINAL_COLUMNS)
+                        )
+                if not sections:
+                    return [], [], []
+            else:
+                sections = timing_ini.sections()
+
+            for section in sections:
+                if section.strip() != ".":
+                    print()
+                    print('Test: "{}" in module {}.\n'.format(section, module))
+                    future = executor.submit(
+                        run_section_test, sim, module, section, path,
+                        simulator, build_dir, build_args, panda_src,
+                        panda_build_dir, collect
                     )
-            if not sections:
-                return [], [], None
+                    futures.append((section, future))
+            test_name = None
+
+    # Collected in submission order so the results don't depend on timing
+    for section, future in futures:
+        results, coverage_file_path = future.result()
+        if coverage_file_path is not None:
+            coverage_file_paths.append(coverage_file_path)
+        if results == (1, 0):
+            # ran 1 test, 0 failed
+            passed.append(section)
+        elif results == (1, 1):
+            # ran 1 test, 1 failed
+            failed.append(section)
         else:
-            sections = timing_ini.sections()
-
-        for section in sections:
-            if section.strip() != ".":
-                test_name = section
-                print()
-                print('Test: "{}" in module {}.\n'.format(test_name, module))
-                xml_path: Path = sim.test(  # type: ignore
-                    hdl_toplevel=top_level,
-                    test_module="cocotb_simulate_test",
-                    build_dir=build_dir,
-                    test_args=get_test_args(simulator, build_args, test_name),
-                    elab_args=get_elab_args(simulator),
-                    plusargs=get_plusargs(simulator, test_name),
-                    extra_env={
-                        "module": module,
-                        "test_name": test_name,
-                        "simulator": simulator,
-                        "sim_build_dir": str(build_dir),
-                        "timing_ini_path": str(path),
-                        "panda_src_dir": str(panda_src),
-                        "panda_build_dir": str(panda_build_dir),
-                        "collect": str(collect),
-                    },
-                )
-                results: tuple[int, int] = runner.get_results(xml_path)  # type: ignore
-                if simulator == "nvc":
-                    coverage_file_paths.append(
-                        collect_coverage_file(build_dir, top_level, test_name)
-                    )
-                if results == (1, 0):
-                    # ran 1 test, 0 failed
-                    passed.append(test_name)
-                elif results == (1, 1):
-                    # ran 1 test, 1 failed
-                    failed.append(test_name)
-                else:
-                    raise ValueError(f"Results unclear: {results}")
-                cleanup_dir(test_name, build_dir)
-        test_name = None
-    if simulator == "nvc":
-        coverage_report_path = merge_coverage_data(
-            build_dir, module, coverage_file_paths
-        )
-    return passed, failed, coverage_report_path
+            raise ValueError(f"Results unclear: {results}")
+    # nvc merges the files itself when reporting, no need for a merge here
+    return passed, failed, coverage_file_paths
+
+
+def timed_test_module(
+    module: str, **kwargs: Any
+) -> tuple[list[str], list[str], list[Path], float]:
+    """Run tests for a module and measure how long they took.
+
+    Args:
+        module: Name of module.
+        kwargs: Keyword arguments passed on to test_module.
+    Returns:
+        The results of test_module followed by the time taken in seconds.
+    """
+    t0 = time.time()
+    passed, failed, coverage_file_paths = test_module(module, **kwargs)
+    return passed, failed, coverage_file_paths, time.time() - t0
 
 
 def run_tests():
@@ -555,40 +815,68 @@ def run_tests():
     collect = bool(args.c)
     results: dict[str, list[list[str]]] = {}
     times: dict[str, float | None] = {}
-    coverage_reports: dict[str, Path | None] = {}
+    coverage_files: dict[str, list[Path]] = {}
+    modules = [module.strip("\n") for module in modules]
     for module in modules:
-        t0 = time.time()
-        module = module.strip("\n")
-        results[module] = [[], []]
-        # [[passed], [failed]]
         print()
         print(
-            "* Testing module \033[1m{}\033[0m *".format(module.strip("\n")).center(
-                shutil.get_terminal_size().columns
+            "* Testing module \033[1m{}\033[0m *".format(module).center(
+                TERMINAL_COLUMNS
             )
         )
         print(
             "---------------------------------------------------".center(
-                shutil.get_terminal_size().columns
+                TERMINAL_COLUMNS
             )
         )
-        results[module][0], results[module][1], coverage_reports[module] = test_module(
-            module,
-            test_name=args.test_name,
-            simulator=simulator,
-            panda_src=args.panda_src,
-            panda_build_dir=args.panda_build_dir,
-            collect=collect,
-        )
-        t1 = time.time()
-        times[module] = round(t1 - t0, 2)
+    # Modules build and simulate in their own sim_build_{module} directory,
+    # so they can run at the same time in separate processes
+    cpu_count = os.cpu_count() or 1
+    max_workers = max(1, min(len(modules), cpu_count))
+    # The CPUs are shared between the modules, so that there is at most one
+    # simulator per CPU
+    max_simulations = max(1, cpu_count // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                timed_test_module,
+                module,
+                test_name=args.test_name,
+                simulator=simulator,
+                panda_src=args.panda_src,
+                panda_build_dir=args.panda_build_dir,
+                collect=collect,
+                incremental=args.incremental,
+                max_simulations=max_simulations,
+            ): module
+            for module in modules
+        }
+        for future in as_completed(futures):
+            module = futures[future]
+            passed, failed, coverage_file_paths, elapsed = future.result()
+            # [[passed], [failed]]
+            results[module] = [passed, failed]
+            coverage_files[module] = coverage_file_paths
+            times[module] = round(elapsed, 2)
+    # Report in the order the modules were given, not completion order
+    results = {module: results[module] for module in modules}
+    # The coverage reports and the export are independent nvc runs, so they
+    # all run at once while the results are printed in order
+    coverage_reports = {
+        module: start_coverage_report(paths)
+        for module, paths in coverage_files.items() if paths
+    }
+    # A single nvc run merges and exports the coverage of every test
+    coverage_file_paths = [
+        path for paths in coverage_files.values() for path in paths
+    ]
+    export = export_coverage_data(Path("cocotb_coverage.xml"), coverage_file_paths)
     print("___________________________________________________")
     print("\nResults:")
     for module in results:
         print_results(module, results[module][0], results[module][1], times[module])
-        path = coverage_reports[module]
-        if path is not None:
-            print_coverage_data(path)
+        if module in coverage_reports:
+            print_coverage_data(coverage_reports[module])
         build_dir = f"sim_build_{module}"
         print_errors(results[module][1], build_dir)
     print("___________________________________________________")
@@ -597,9 +885,7 @@ def run_tests():
     print("\nTime taken: {}s.".format(round(t_time_1 - t_time_0, 2)))
     print("___________________________________________________\n")
     print(f"Simulator: {simulator}\n")
-
-    report_paths = [path for path in coverage_reports.values() if path is not None]
-    export_coverage_data(Path("cocotb_coverage.xml"), report_paths)
+    print_nvc_output(export)
 
 
 def main():
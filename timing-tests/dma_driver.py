@@ -1,7 +1,7 @@
 import cocotb
+import numpy as np
 
 from cocotb.triggers import RisingEdge
-from collections import deque
 from pathlib import Path
 
 
@@ -14,31 +14,57 @@ class DMADriver(object):
         self.dut.dma_valid_i.value = 0
         self.module = module
         self.panda_src = panda_src
+        self.assets = {}
         cocotb.start_soon(self.run())
 
+    def get_asset(self, addr):
+        # tables are parsed on their first request and kept for the next
+        # ones, they are named after the address they are requested from
+        data = self.assets.get(addr)
+        if data is None:
+            path = Path(self.panda_src) / 'modules' / self.module / \
+                'tests_assets' / f'{addr}.txt'
+            try:
+                # decimal tables are parsed by numpy in C, tolist() gives back
+                # the python ints that cocotb writes fastest
+                data = np.loadtxt(path, dtype=np.uint64, skiprows=1,
+                                  ndmin=1).tolist()
+            except ValueError:
+                # hex or out of range entries
+                with open(path, 'r') as f:
+                    lines = list(f)[1:]
+
+                data = [
+                    int(item[2:], 16) if item.startswith('0x') else int(item)
+                    for item in lines]
+
+            self.assets[addr] = data
+
+        return data
+
     async def run(self):
+        # the triggers and signals are looked up once, not on every cycle
+        clk_edge = RisingEdge(self.dut.clk_i)
+        req_edge = RisingEdge(self.dut.dma_req_o)
+        data_i = self.dut.dma_data_i
+        valid_i = self.dut.dma_valid_i
         while True:
-            await RisingEdge(self.dut.dma_req_o)
-            await RisingEdge(self.dut.clk_i)
+            await req_edge
+            await clk_edge
             self.dut.dma_ack_i.value = 1
             addr = self.dut.dma_addr_o.value.to_unsigned()
             length = self.dut.dma_len_o.value.to_unsigned()
-            with open(Path(self.panda_src) / 'modules' / self.module / 'tests_assets' / 
-                      f'{addr}.txt', 'r') as f:
-                lines = list(f)[1:]
-
-            data = deque([int(item[2:], 16) if item.startswith('0x') else
-                          int(item) for item in lines])
-            await RisingEdge(self.dut.clk_i)
+            data = self.get_asset(addr)
+            await clk_edge
             self.dut.dma_ack_i.value = 0
             for i in range(length - 1):
-                self.dut.dma_data_i.value = data.popleft()
-                self.dut.dma_valid_i.value = 1
-                await RisingEdge(self.dut.clk_i)
+                data_i.value = data[i]
+                valid_i.value = 1
+                await clk_edge
 
-            self.dut.dma_data_i.value = data.popleft()
-            self.dut.dma_valid_i.value = 1
+            data_i.value = data[length - 1]
+            valid_i.value = 1
             self.dut.dma_done_i.value = 1
-            await RisingEdge(self.dut.clk_i)
+            await clk_edge
             self.dut.dma_done_i.value = 0
-            self.dut.dma_valid_i.value = 0
+            valid_i.value = 0
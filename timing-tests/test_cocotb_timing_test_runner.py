@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import pytest
+
+import cocotb_timing_test_runner as timing_runner
+
+
+# Files in each simulator's build that a test needs, relative to the build
+# directory, and files that it doesn't, such as those of a test run before
+BUILDS = {
+    "nvc": (["top/_NVC_LIB", "top/TOP.PGEN"], ["0_test/results.xml"]),
+    "ghdl": (["top-obj08.cf", "pgen", "pgen.o"], ["0_test/results.xml"]),
+}
+
+
+@pytest.mark.parametrize("simulator", BUILDS)
+def test_copy_build(tmp_path, monkeypatch, simulator):
+    monkeypatch.setattr(timing_runner, "WORKING_DIR", tmp_path)
+    copied, not_copied = BUILDS[simulator]
+    for name in copied + not_copied:
+        path = tmp_path / "sim_build_pgen" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+
+    timing_runner.copy_build(simulator, "sim_build_pgen", "sim_build_pgen_1")
+
+    test_dir = tmp_path / "sim_build_pgen_1"
+    for name in copied:
+        assert (test_dir / name).read_text() == name
+    for name in not_copied:
+        assert not (test_dir / name).exists()
+
+
+def test_copy_build_unknown_simulator(tmp_path, monkeypatch):
+    monkeypatch.setattr(timing_runner, "WORKING_DIR", tmp_path)
+    with pytest.raises(NotImplementedError):
+        timing_runner.copy_build("vcs", "sim_build_pgen", "sim_build_pgen_1")